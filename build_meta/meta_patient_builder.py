@@ -1,10 +1,28 @@
 import os
+import json
+import hashlib
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import requests
 import logging
+import threading
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from urllib.parse import urlencode, urljoin
 from typing import List, Dict, Union, Tuple, Optional, Sequence
+import fhirpathpy
 from fhir_pyrate import Ahoy
 from fhir_pyrate.pirate import Pirate
+from fhir_pyrate.util import FHIRObj
+from fhir_pyrate.util.token_auth import TokenAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import time  # Import the time module for measuring execution time
 
@@ -19,22 +37,278 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# FHIR paths of the resource extractions, shared by the extract_* methods and main's prefetch
+_FHIR_PATHS = {
+    "Procedure": [
+        ("procedure_id", "id"),
+        ("patient_id", "subject.reference.replace('Patient/', '')"),
+        ("status", "status"),
+        ("code_code", "code.coding[0].code"),
+        ("code_display", "code.coding[0].display"),
+        ("performed_date_time", "performedDateTime"),
+    ],
+    "Observation": [
+        ("observation_id", "id"),
+        ("patient_id", "subject.reference.replace('Patient/', '')"),
+        ("status", "status"),
+        ("code_code", "code.coding[0].code"),
+        ("code_display", "code.coding[0].display"),
+        ("effective_date_time", "effectiveDateTime"),
+        ("value_quantity", "valueQuantity.value"),
+        ("value_unit", "valueQuantity.unit"),
+    ],
+    "Condition": [
+        ("diagnosis_id", "id"),
+        ("patient_id", "subject.reference.replace('Patient/', '')"),
+        ("clinical_status", "clinicalStatus.coding[0].display"),
+        ("verification_status", "verificationStatus.coding[0].display"),
+        ("code_code", "code.coding[0].code"),
+        ("code_display", "code.coding[0].display"),
+        ("onset_date_time", "onsetDateTime"),
+    ],
+    "Medication": [
+        ("medication_id", "id"),
+        ("code_code", "code.coding[0].code"),
+        ("code_display", "code.coding[0].display"),
+        ("form_code", "form.coding[0].code"),
+        ("form_display", "form.coding[0].display"),
+    ],
+    "MedicationStatement": [
+        ("medication_statement_id", "id"),
+        ("patient_id", "subject.reference.replace('Patient/', '')"),
+        ("status", "status"),
+        ("effective_date_time", "effectiveDateTime"),
+        ("medication_code", "medicationCodeableConcept.coding[0].code"),
+        ("medication_display", "medicationCodeableConcept.coding[0].display"),
+        ("dosage_instruction", "dosage[0].text"),
+    ],
+}
+
+# Low-cardinality coded and display columns that are stored as category dtype after extraction
+_CATEGORICAL_COLS = {
+    "status",
+    "class_code",
+    "class_display",
+    "type_code",
+    "sex",
+    "gender",
+    "clinical_status",
+    "verification_status",
+    "form_code",
+    "form_display",
+    "code_display",
+    "medication_display",
+}
+
+# Rows buffered before a streamed extraction writes a Parquet row group
+_ROW_GROUP_ROWS = 64 * 1024
+
+# Rows converted to Arrow at a time when store_df writes CSV
+_CSV_CHUNK_ROWS = 100_000
+
+
 # Helper functions
 def extract_id(id_str):
     """Extract ID from a FHIR reference."""
-    if isinstance(id_str, str) and "/" in id_str:
-        return id_str.split("/")[-1]
+    if isinstance(id_str, str):
+        _, sep, tail = id_str.rpartition("/")
+        return tail if sep else id_str
     return id_str
 
 
-def store_df(df, output_path, resource_name):
-    """Store DataFrame as CSV file."""
+def search_rejected(bundles):
+    """
+    Check whether a search was rejected rather than answered. fhir_pyrate yields no bundle
+    at all when the request failed (e.g. HTTP 4xx); some servers instead answer with an
+    OperationOutcome carrying an error.
+    """
+    if not bundles:
+        return True
+    return any(
+        entry.resource.resourceType == "OperationOutcome"
+        and any(issue.severity in ("error", "fatal") for issue in entry.resource.issue or [])
+        for bundle in bundles
+        for entry in bundle.entry or []
+    )
+
+
+def bundles_to_df(bundles, compiled_fhir_paths, resource_type):
+    """Build a DataFrame of the given resource type from bundles, like fhir_pyrate's FHIR path extraction."""
+    records = [
+        record
+        for bundle in bundles
+        for record in fhir_path_records(bundle, compiled_fhir_paths).get(resource_type, [])
+    ]
+    return pd.DataFrame(records).dropna(axis=1, how="all")
+
+
+def join_meta_patients(resource_df, meta_idx, resource_suffix):
+    """
+    Inner-join a resource DataFrame on patient_id with meta patients indexed by linked_patient_id.
+
+    Produces the same columns as pd.merge(left_on="patient_id", right_on="linked_patient_id").
+    """
+    merged_df = resource_df.join(
+        meta_idx, on="patient_id", how="inner", lsuffix=resource_suffix, rsuffix="_meta_patient"
+    )
+    if "patient_id" in meta_idx.columns:
+        # join also keeps the key as an unsuffixed patient_id column next to the suffixed ones
+        merged_df = merged_df.drop(columns="patient_id", errors="ignore")
+    return merged_df
+
+
+def fhir_path_columns(bundle, compiled_fhir_paths):
+    """
+    Evaluate compiled FHIRPath expressions for every resource of a bundle into one list per
+    column, grouped by resource type.
+
+    Values follow fhir_pyrate's parse_fhir_path: empty results become None, single results
+    are unwrapped and the first non-empty result wins for a repeated column name. Each
+    resource is converted to a dict once instead of once per expression, and the column
+    lists are allocated at their final length and filled by row.
+    """
+    entries = bundle.entry or []
+    names = list(dict.fromkeys(name for name, _ in compiled_fhir_paths))
+    row_counts = Counter(entry.resource.resourceType for entry in entries)
+    columns = {resource_type: {name: [None] * count for name in names} for resource_type, count in row_counts.items()}
+    next_rows = dict.fromkeys(row_counts, 0)
+    for entry in entries:
+        resource = entry.resource
+        type_columns = columns[resource.resourceType]
+        row = next_rows[resource.resourceType]
+        next_rows[resource.resourceType] = row + 1
+        resource_dict = resource.to_dict()
+        for name, compiled_path in compiled_fhir_paths:
+            column = type_columns[name]
+            if column[row] is None:
+                result = compiled_path(resource=resource_dict)
+                column[row] = None if len(result) == 0 else result[0] if len(result) == 1 else result
+    return columns
+
+
+def fhir_path_records(bundle, compiled_fhir_paths):
+    """
+    Bundle processing function for fhir_pyrate, a drop-in for parse_fhir_path that takes
+    its values from fhir_path_columns. Like parse_fhir_path, None values are left out.
+    """
+    return {
+        resource_type: [
+            {name: value for name, value in zip(columns, row) if value is not None}
+            for row in zip(*columns.values())
+        ]
+        for resource_type, columns in fhir_path_columns(bundle, compiled_fhir_paths).items()
+    }
+
+
+def stream_schema(column_names, column_types):
+    """
+    Build the Parquet schema for a streamed extraction. Integers and decimals (whose precision
+    is inferred per bundle) are widened to floats so later bundles still fit; columns never
+    seen with a value become strings.
+    """
+    fields = []
+    for name in column_names:
+        column_type = column_types.get(name, pa.string())
+        if pa.types.is_integer(column_type) or pa.types.is_decimal(column_type):
+            column_type = pa.float64()
+        fields.append(pa.field(name, column_type))
+    return pa.schema(fields)
+
+
+def batches_to_table(batches, schema):
+    """Reorder, fill up and cast bundle record batches to the given schema and join them into one table."""
+    conformed = [
+        pa.RecordBatch.from_arrays(
+            [
+                batch.column(field.name).cast(field.type) if field.name in batch.schema.names else pa.nulls(len(batch), field.type)
+                for field in schema
+            ],
+            schema=schema,
+        )
+        for batch in batches
+    ]
+    return pa.Table.from_batches(conformed, schema=schema)
+
+
+def coalesce_token_refresh(session):
+    """
+    Make the token refresh of a fhir_pyrate TokenAuth session single-flight.
+
+    TokenAuth refreshes from a response hook, so every thread that sees an expired token
+    would call the refresh URL. Here only one thread refreshes while the others wait on the
+    lock; afterwards they notice that their request was sent with an older token than the
+    current one and just resend it instead of refreshing again. The resend happens after
+    the lock is released, as its response runs through this hook again.
+    """
+    token_auth = session.auth
+    if not isinstance(token_auth, TokenAuth):
+        return
+    refresh_hook = token_auth._refresh_hook
+    refresh_lock = threading.Lock()
+
+    def coalesced_refresh_hook(response, *args, **kwargs):
+        unauthorized = response.status_code == requests.codes.unauthorized
+        if not unauthorized and not token_auth.is_refresh_required():
+            return refresh_hook(response, *args, **kwargs)
+        if unauthorized:
+            # Same login attempt limit as TokenAuth, counted on the resent request
+            login_attempts = getattr(response.request, "login_reattempted_times", 0) + 1
+            if login_attempts >= token_auth._max_login_attempts:
+                response.raise_for_status()
+            setattr(response.request, "login_reattempted_times", login_attempts)
+        with refresh_lock:
+            if token_auth.token is None:
+                response.raise_for_status()
+            if response.request.headers.get("Authorization") == f"Bearer {token_auth.token}":
+                token_auth.token = None
+                token_auth.refresh_token()
+            elif not unauthorized:
+                # Another thread refreshed the token while this request was in flight
+                response.raise_for_status()
+                return None
+        return session.send(token_auth(response.request), **kwargs)
+
+    response_hooks = session.hooks["response"]
+    response_hooks[response_hooks.index(refresh_hook)] = coalesced_refresh_hook
+
+
+def narrow_dtypes(df):
+    """Cast coded columns to category and the patient ID column to pyarrow-backed strings."""
+    for column in df.columns.intersection(list(_CATEGORICAL_COLS)):
+        df[column] = df[column].astype("category")
+    if "patient_id" in df.columns:
+        df["patient_id"] = df["patient_id"].astype("string[pyarrow]")
+    return df
+
+
+def store_df(df, output_path, resource_name, partition_cols=None):
+    """
+    Store DataFrame as a zstd-compressed Parquet file.
+
+    If partition_cols is given, output_path is treated as the root directory of a
+    partitioned Parquet dataset instead of a single file. A ".csv" output_path is
+    written as CSV with pyarrow's multithreaded writer instead, in slices of _CSV_CHUNK_ROWS rows.
+    """
     logger.info(f"Storing {resource_name} data with {len(df)} rows to {output_path}")
-    df.reset_index(drop=True).to_csv(output_path, index=False)
+    if Path(output_path).suffix == ".csv":
+        # Convert and write in slices so only one slice is held as an Arrow table at a time
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        with pa_csv.CSVWriter(str(output_path), schema) as writer:
+            for start in range(0, len(df), _CSV_CHUNK_ROWS):
+                chunk = df.iloc[start:start + _CSV_CHUNK_ROWS]
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        return
+    df.reset_index(drop=True).to_parquet(
+        output_path,
+        engine="pyarrow",
+        compression="zstd",
+        index=False,
+        partition_cols=partition_cols,
+    )
 
 
 class SimpleMetaPatientBuilder:
-    def __init__(self, base_url=None, output_dir="./output", num_processes=20, resources_per_page=750, is_initial_test=False):
+    def __init__(self, base_url=None, output_dir="./output", num_processes=20, resources_per_page=750, is_initial_test=False, cache_ttl=24 * 60 * 60, use_bulk_export=None, force_refresh=None, output_format=None):
         """
         Initialize the SimpleMetaPatientBuilder.
 
@@ -44,6 +318,10 @@ class SimpleMetaPatientBuilder:
         - num_processes: Number of parallel processes for FHIR requests (adjusted default)
         - resources_per_page: Number of resources to request per page (_count parameter) (adjusted default)
         - is_initial_test: Flag for limiting initial extraction for testing
+        - cache_ttl: Seconds a cached FHIR response stays valid (None never expires)
+        - use_bulk_export: Let main() fetch the resources with a FHIR Bulk Data $export (defaults to environment variable)
+        - force_refresh: Ignore cached extractions and meta patients from earlier runs (defaults to environment variable)
+        - output_format: "parquet" or "csv", the format of the merged outputs written by main() (defaults to environment variable)
         """
         # Use environment variables if parameters not provided
         self.base_url = base_url or os.environ.get(
@@ -52,15 +330,40 @@ class SimpleMetaPatientBuilder:
         self.num_processes = num_processes
         self.resources_per_page = resources_per_page
         self.is_initial_test = is_initial_test
+        self.cache_ttl = cache_ttl
+        if use_bulk_export is None:
+            use_bulk_export = os.environ.get("USE_BULK_EXPORT", "").lower() in ("1", "true", "yes")
+        self.use_bulk_export = use_bulk_export
+        if force_refresh is None:
+            force_refresh = os.environ.get("FORCE_REFRESH", "").lower() in ("1", "true", "yes")
+        self.force_refresh = force_refresh
+        if output_format is None:
+            output_format = os.environ.get("OUTPUT_FORMAT", "parquet").lower()
+        if output_format not in ("parquet", "csv"):
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.output_format = output_format
+
+        # One pooled keep-alive session, reused by the authentication and every search
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.num_processes,
+            pool_maxsize=self.num_processes * 2,
+            max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
         # Setup authentication
         self.auth = Ahoy(
             auth_method="env",
+            session=self.session,
             username=os.environ.get("FHIR_USER", "parnath"),
             auth_url=os.environ.get("BASIC_AUTH", "https://ship.ume.de/app/Auth/v1/basicAuth"),
             refresh_url=os.environ.get("REFRESH_AUTH", "https://ship.ume.de/app/Auth/v1/refresh"),
         )
 
+        coalesce_token_refresh(self.session)
+
         # Initialize Pirate
         self.search = Pirate(
             auth=self.auth,
@@ -72,6 +375,219 @@ class SimpleMetaPatientBuilder:
         # Create output directory
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = self.output_dir / ".cache"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # Compiled FHIRPath expressions, keyed by the FHIR paths they were built from
+        self._fhirpath_cache = {}
+        # First result pages fetched by prefetch_first_pages, keyed by search
+        self._prefetched_pages = {}
+        # NDJSON file URLs from bulk_export, keyed by resource type
+        self._export_files = {}
+
+    def _compiled_fhir_paths(self, fhir_paths):
+        """
+        Return the (column name, compiled expression) pairs for the given FHIR paths,
+        compiling the expressions only the first time a set of paths is used by this builder.
+        """
+        key = tuple(fhir_paths)
+        if key not in self._fhirpath_cache:
+            self._fhirpath_cache[key] = [
+                (path[0], fhirpathpy.compile(path=path[1])) if isinstance(path, tuple) else (path, fhirpathpy.compile(path=path))
+                for path in fhir_paths
+            ]
+        return self._fhirpath_cache[key]
+
+    def _search_params(self, request_params=None):
+        """Add the page size and sort order used by every extraction to the given request parameters."""
+        if request_params is None:
+            request_params = {}
+
+        request_params["_count"] = str(self.resources_per_page)
+        # fhir_pyrate re-requests the first page sorted by _id when a search has several pages,
+        # sorting up front keeps prefetched and searched pages identical
+        request_params.setdefault("_sort", "_id")
+
+        # --- Potential initial limit for testing ---
+        if self.is_initial_test:
+            request_params["_count"] = "100"
+        return request_params
+
+    @staticmethod
+    def _search_key(resource_type, request_params):
+        return resource_type, json.dumps(request_params, sort_keys=True, default=str)
+
+    def prefetch_first_pages(self, searches):
+        """
+        Fetch the first result page of several searches with one FHIR batch request.
+
+        searches is a list of (resource_type, request_params) pairs, optionally with the
+        fhir_paths of the extraction as a third item; searches whose result is then still
+        cached on disk are not fetched. The pages are picked up by default_extraction, which
+        then only follows the next links. Servers that reject batch searches are left to the
+        regular per-resource searches.
+        """
+        searches = [
+            (resource_type, self._search_params(dict(request_params or {})))
+            for resource_type, request_params, *fhir_paths in searches
+            if not (fhir_paths and self.is_search_cached(resource_type, request_params, fhir_paths[0]))
+        ]
+        if not searches:
+            return
+        batch = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [
+                {"request": {"method": "GET", "url": f"{resource_type}?{urlencode(request_params)}"}}
+                for resource_type, request_params in searches
+            ],
+        }
+        try:
+            response = self.session.post(self.base_url, json=batch, headers={"Content-Type": "application/fhir+json"})
+            response.raise_for_status()
+            batch_response = orjson.loads(response.content)
+        except Exception as e:
+            logger.warning(f"Batch search not available, searching resources separately: {e}")
+            return
+        if batch_response.get("type") != "batch-response":
+            logger.warning("Batch search not available, searching resources separately")
+            return
+
+        for (resource_type, request_params), entry in zip(searches, batch_response.get("entry", [])):
+            status = str(entry.get("response", {}).get("status", ""))
+            resource = entry.get("resource") or {}
+            if status.startswith("200") and resource.get("resourceType") == "Bundle":
+                self._prefetched_pages[self._search_key(resource_type, request_params)] = FHIRObj(**resource)
+            else:
+                logger.warning(f"Batch search for {resource_type} failed with status {status}")
+
+    def bulk_export(self, resource_types, poll_interval=10, max_wait=60 * 60):
+        """
+        Run a system-level FHIR Bulk Data $export for the given resource types.
+
+        The NDJSON files of the finished export are picked up by default_extraction for
+        unfiltered searches of those types. Returns False if the server does not support
+        the export or it did not finish within max_wait seconds.
+        """
+        try:
+            response = self.session.get(
+                f"{self.base_url.rstrip('/')}/$export",
+                params={"_type": ",".join(resource_types)},
+                headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+            )
+            response.raise_for_status()
+            status_url = response.headers["Content-Location"]
+
+            deadline = time.time() + max_wait
+            while True:
+                response = self.session.get(status_url, headers={"Accept": "application/json"})
+                response.raise_for_status()
+                if response.status_code != requests.codes.accepted:
+                    break
+                if time.time() > deadline:
+                    logger.warning(f"Bulk export did not finish within {max_wait} seconds")
+                    return False
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(int(retry_after) if retry_after.isdigit() else poll_interval)
+            manifest = response.json()
+        except Exception as e:
+            logger.warning(f"Bulk export not available, searching resources instead: {e}")
+            return False
+
+        for output in manifest.get("output", []):
+            self._export_files.setdefault(output["type"], []).append(output["url"])
+        logger.info(f"Bulk export finished with {len(manifest.get('output', []))} files")
+        return True
+
+    def _export_bundles(self, urls):
+        """Read bulk export NDJSON files as bundles of resources_per_page resources."""
+        for url in urls:
+            with self.session.get(url, headers={"Accept": "application/fhir+ndjson"}, stream=True) as response:
+                response.raise_for_status()
+                entries = []
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    entries.append({"resource": orjson.loads(line)})
+                    if len(entries) == self.resources_per_page:
+                        yield FHIRObj(resourceType="Bundle", entry=entries)
+                        entries = []
+                if entries:
+                    yield FHIRObj(resourceType="Bundle", entry=entries)
+
+    def _follow_pages(self, bundle):
+        """Yield a prefetched search bundle and the pages behind its next links."""
+        while bundle is not None:
+            yield bundle
+            next_url = next((link.url for link in bundle.link or [] if link.relation == "next"), None)
+            if next_url is None:
+                return
+            response = self.session.get(urljoin(self.base_url.rstrip("/") + "/", next_url))
+            response.raise_for_status()
+            bundle = FHIRObj(**orjson.loads(response.content))
+
+    def _cache_path(self, resource_type, request_params, fhir_paths):
+        """Return the cache file for a query, keyed by a hash of its parameters."""
+        key = hashlib.blake2b(
+            json.dumps([resource_type, request_params, list(fhir_paths)], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return self.cache_dir / f"{key}.parquet"
+
+    def is_search_cached(self, resource_type, request_params, fhir_paths):
+        """Check whether default_extraction would load this search from the disk cache."""
+        cache_path = self._cache_path(resource_type, self._search_params(dict(request_params or {})), fhir_paths)
+        return not self.force_refresh and self._is_cache_fresh(cache_path)
+
+    def _is_cache_fresh(self, cache_path):
+        """Check whether a cache file exists and is younger than cache_ttl."""
+        if not cache_path.exists():
+            return False
+        return self.cache_ttl is None or time.time() - cache_path.stat().st_mtime < self.cache_ttl
+
+    def _stream_to_parquet(self, bundles, resource_type, fhir_paths, output_path):
+        """
+        Write the search bundles to a Parquet file one bundle at a time instead of holding
+        the whole result set in memory. Bundles are only held back until every column has
+        shown its type, or at most _ROW_GROUP_ROWS rows; columns without a value by then
+        are written as strings. Returns False if no rows were written.
+
+        Bundles are buffered as record batches and written as one row group per
+        _ROW_GROUP_ROWS rows, so the file does not end up with a row group per page.
+        """
+        compiled_paths = self._compiled_fhir_paths(fhir_paths)
+        column_names = list(dict.fromkeys(name for name, _ in compiled_paths))
+        column_types = {}
+        batches = []
+        buffered_rows = 0
+        writer = None
+        try:
+            for bundle in bundles:
+                # Build the batch straight from column lists, without a DataFrame per bundle; other
+                # resource types in the bundle (e.g. an OperationOutcome) are skipped
+                bundle_columns = fhir_path_columns(bundle, compiled_paths).get(resource_type)
+                if not bundle_columns:
+                    continue
+                batches.append(pa.RecordBatch.from_pydict(bundle_columns))
+                buffered_rows += len(batches[-1])
+                if writer is None:
+                    for field in batches[-1].schema:
+                        if not pa.types.is_null(field.type):
+                            column_types.setdefault(field.name, field.type)
+                    if len(column_types) < len(column_names) and buffered_rows < _ROW_GROUP_ROWS:
+                        continue
+                    writer = pq.ParquetWriter(output_path, stream_schema(column_names, column_types), compression="zstd")
+                if buffered_rows >= _ROW_GROUP_ROWS:
+                    writer.write_table(batches_to_table(batches, writer.schema))
+                    batches = []
+                    buffered_rows = 0
+
+            if batches:
+                writer = writer or pq.ParquetWriter(output_path, stream_schema(column_names, column_types), compression="zstd")
+                writer.write_table(batches_to_table(batches, writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        return writer is not None
 
     def default_extraction(
         self,
@@ -80,71 +596,84 @@ class SimpleMetaPatientBuilder:
         fhir_paths: Sequence[Union[str, Tuple[str, str]]],
         request_params: Optional[Dict[str, str]] = None,
         limit: int = 10,  # This limit might be overridden by resources_per_page
+        force_refresh: bool = False,
     ):
         """
         Generic extraction method for FHIR resources.
+
+        Results are cached on disk per query; set force_refresh (here or on the builder) to
+        bypass the cache.
         """
         logger.info(f"Extracting {resource_type} data")
         start_time = time.time()
-        output_path = self.output_dir / f"{output_name}.csv"
+        output_path = self.output_dir / f"{output_name}.parquet"
 
         # Set up request parameters
-        if request_params is None:
-            request_params = {}
-
-        request_params["_count"] = str(self.resources_per_page)
-
-        # --- Potential initial limit for testing ---
-        if self.is_initial_test:
-            request_params["_count"] = "100"
+        request_params = self._search_params(request_params)
 
+        streamed = False
         try:
-            result = self.search.steal_bundles_to_dataframe(
-                resource_type=resource_type,
-                request_params=request_params,
-                fhir_paths=list(fhir_paths),
-            )
-
-            # Convert result to DataFrame
-            if isinstance(result, dict):
-                df = pd.DataFrame()
-                for key, value in result.items():
-                    if isinstance(value, pd.DataFrame) and not value.empty:
-                        df = value
-                        break
+            cache_path = self._cache_path(resource_type, request_params, fhir_paths)
+            cached = not (force_refresh or self.force_refresh) and self._is_cache_fresh(cache_path)
+            if cached:
+                logger.info(f"Loading cached {resource_type} data from {cache_path}")
+                df = pd.read_parquet(cache_path)
+            elif resource_type in self._export_files and set(request_params) <= {"_count", "_sort"}:
+                export_urls = self._export_files[resource_type]
+                logger.info(f"Reading {resource_type} from {len(export_urls)} bulk export files")
+                streamed = self._stream_to_parquet(self._export_bundles(export_urls), resource_type, fhir_paths, output_path)
+                df = pd.read_parquet(output_path) if streamed else pd.DataFrame()
             else:
-                df = result
+                # A first page from prefetch_first_pages already carries the total
+                first_page = self._prefetched_pages.pop(self._search_key(resource_type, request_params), None)
+                if first_page is not None:
+                    bundles = self._follow_pages(first_page)
+                else:
+                    # The total is read from the first page of the search itself, not a separate request
+                    bundles = self.search.steal_bundles(resource_type=resource_type, request_params=request_params)
+                    first_page = next(bundles, None)
+                    bundles = chain([first_page], bundles) if first_page is not None else iter(())
+                total = getattr(first_page, "total", None)
+
+                # Large result sets are written bundle by bundle instead of accumulated in memory
+                if total is not None and total >= 2 * int(request_params["_count"]):
+                    logger.info(f"Streaming {total} {resource_type} resources to {output_path}")
+                    streamed = self._stream_to_parquet(bundles, resource_type, fhir_paths, output_path)
+                    df = pd.read_parquet(output_path) if streamed else pd.DataFrame()
+                else:
+                    df = bundles_to_df(list(bundles), self._compiled_fhir_paths(fhir_paths), resource_type)
+
+            # Exported and searched results are cached alike
+            if not cached and not df.empty:
+                df.reset_index(drop=True).to_parquet(cache_path, engine="pyarrow", index=False)
 
             if df.empty:
                 logger.warning(f"No {resource_type} data found")
-                return df, []  # Return empty list for patient IDs
+                return df, np.array([], dtype=object)  # Return empty array for patient IDs
+
+            df = narrow_dtypes(df)
 
             # Extract patient IDs if the resource has a subject
-            patient_ids = []
+            patient_ids = np.array([], dtype=object)
             if "subject.reference.replace('Patient/', '')" in [path for _, path in fhir_paths]:
-                patient_ids = df["patient_id"].unique().tolist()
+                # Hash the ID values only, drop_duplicates would build a deduplicated Series first
+                patient_ids = np.asarray(df["patient_id"].dropna().unique(), dtype=object)
                 logger.info(f"Found {len(patient_ids)} unique patients in {resource_type}")
 
-            # Store the data
-            store_df(df, output_path, resource_type)
+            # Store the data, streamed extractions are already on disk
+            if not streamed:
+                store_df(df, output_path, resource_type)
             end_time = time.time()
             logger.info(f"Finished extracting {resource_type} in {end_time - start_time:.2f} seconds.")
             return df, patient_ids
 
         except Exception as e:
             logger.error(f"Error during extraction of {resource_type}: {e}")
-            return pd.DataFrame(), []
+            return pd.DataFrame(), np.array([], dtype=object)
 
     def extract_procedures(self):
         """Extract procedures from the FHIR server."""
-        fhir_paths = [
-            ("procedure_id", "id"),
-            ("patient_id", "subject.reference.replace('Patient/', '')"),
-            ("status", "status"),
-            ("code_code", "code.coding[0].code"),
-            ("code_display", "code.coding[0].display"),
-            ("performed_date_time", "performedDateTime"),
-        ]
+        fhir_paths = _FHIR_PATHS["Procedure"]
         procedure_params = {}
         return self.default_extraction(
             output_name="procedures",
@@ -155,16 +684,7 @@ class SimpleMetaPatientBuilder:
 
     def extract_observations(self):
         """Extract observations from the FHIR server."""
-        fhir_paths = [
-            ("observation_id", "id"),
-            ("patient_id", "subject.reference.replace('Patient/', '')"),
-            ("status", "status"),
-            ("code_code", "code.coding[0].code"),
-            ("code_display", "code.coding[0].display"),
-            ("effective_date_time", "effectiveDateTime"),
-            ("value_quantity", "valueQuantity.value"),
-            ("value_unit", "valueQuantity.unit"),
-        ]
+        fhir_paths = _FHIR_PATHS["Observation"]
         observation_params = {}
         return self.default_extraction(
             output_name="observations",
@@ -173,18 +693,16 @@ class SimpleMetaPatientBuilder:
             request_params=observation_params,
         )
 
-    def extract_diagnoses(self):
-        """Extract diagnoses (Condition resources) from the FHIR server."""
-        fhir_paths = [
-            ("diagnosis_id", "id"),
-            ("patient_id", "subject.reference.replace('Patient/', '')"),
-            ("clinical_status", "clinicalStatus.coding[0].display"),
-            ("verification_status", "verificationStatus.coding[0].display"),
-            ("code_code", "code.coding[0].code"),
-            ("code_display", "code.coding[0].display"),
-            ("onset_date_time", "onsetDateTime"),
-        ]
-        diagnosis_params = {}
+    def extract_diagnoses(self, codes: Optional[Sequence[str]] = None):
+        """
+        Extract diagnoses (Condition resources) from the FHIR server.
+
+        codes optionally restricts the search to the given codes (e.g.
+        "http://fhir.de/CodeSystem/bfarm/icd-10-gm|C43.9"), all sent as one comma-joined
+        `code` parameter instead of one search per code.
+        """
+        fhir_paths = _FHIR_PATHS["Condition"]
+        diagnosis_params = {"code": ",".join(codes)} if codes else {}
         return self.default_extraction(
             output_name="diagnoses",
             resource_type="Condition",  # Condition is used for diagnoses
@@ -194,13 +712,7 @@ class SimpleMetaPatientBuilder:
 
     def extract_medications(self):
         """Extract Medication resources from the FHIR server."""
-        fhir_paths = [
-            ("medication_id", "id"),
-            ("code_code", "code.coding[0].code"),
-            ("code_display", "code.coding[0].display"),
-            ("form_code", "form.coding[0].code"),
-            ("form_display", "form.coding[0].display"),
-        ]
+        fhir_paths = _FHIR_PATHS["Medication"]
         medication_params = {}  # Medications don't directly link to a patient in the same way
         return self.default_extraction(
             output_name="medications",
@@ -214,15 +726,7 @@ class SimpleMetaPatientBuilder:
         Extract medication statements from the FHIR server.
         **Consider adding filters here for performance.**
         """
-        fhir_paths = [
-            ("medication_statement_id", "id"),
-            ("patient_id", "subject.reference.replace('Patient/', '')"),
-            ("status", "status"),
-            ("effective_date_time", "effectiveDateTime"),
-            ("medication_code", "medicationCodeableConcept.coding[0].code"),
-            ("medication_display", "medicationCodeableConcept.coding[0].display"),
-            ("dosage_instruction", "dosage[0].text"),
-        ]
+        fhir_paths = _FHIR_PATHS["MedicationStatement"]
         medication_statement_params = {
             "_count": self.resources_per_page,
             # Add filters based on your needs and server capabilities:
@@ -237,44 +741,120 @@ class SimpleMetaPatientBuilder:
             request_params=medication_statement_params,
         )
 
-    def build_meta_patients(self, patient_ids: List[str]):
+    def _search_linked_patients(self, patient_ids: np.ndarray, fhir_paths):
+        """
+        Search the Patient resources linking to any of the given patient IDs with one
+        comma-separated `link` query. Falls back to one search per patient only if the server
+        rejects the batched query (e.g. it does not support the comma-list).
+
+        Returns the linking Patient resources and the patient IDs whose search the server answered.
+        """
+        compiled_paths = self._compiled_fhir_paths(fhir_paths)
+        bundles = list(
+            self.search.steal_bundles(
+                resource_type="Patient",
+                request_params={"link": ",".join(patient_ids), "_count": str(self.resources_per_page)},
+            )
+        )
+        if not search_rejected(bundles):
+            # An empty searchset is a valid answer, none of these patients has a meta patient
+            return bundles_to_df(bundles, compiled_paths, "Patient"), list(patient_ids)
+
+        logger.warning(f"Batched link search was rejected for {len(patient_ids)} patients, searching per patient")
+
+        # The per-patient searches run one after another, this already runs in one of
+        # build_meta_patients' num_processes workers on the pooled session
+        linked_dfs, answered_ids = [], []
+        for patient_id in patient_ids:
+            bundles = list(
+                self.search.steal_bundles(
+                    resource_type="Patient",
+                    request_params={"link": patient_id, "_count": str(self.resources_per_page)},
+                )
+            )
+            if search_rejected(bundles):
+                logger.warning(f"Link search failed for patient {patient_id}")
+                continue
+            answered_ids.append(patient_id)
+            patient_df = bundles_to_df(bundles, compiled_paths, "Patient")
+            if not patient_df.empty:
+                linked_dfs.append(patient_df.assign(patient_id=patient_id))
+        return (pd.concat(linked_dfs, ignore_index=True) if linked_dfs else pd.DataFrame()), answered_ids
+
+    def build_meta_patients(self, patient_ids: Union[np.ndarray, List[str]], batch_size: int = 100, force_refresh: bool = False):
         """
         Build meta patients for the given patient IDs.
+
+        Patients are looked up in batches of batch_size IDs per FHIR search, with up to
+        num_processes searches running at once. Patients already
+        covered by the meta_patients.parquet of an earlier run, or found without a meta patient
+        (listed in unlinked_patients.parquet), are not queried again; set force_refresh to
+        query all of them.
         """
         logger.info(f"Building meta patients for {len(patient_ids)} patients")
         start_time = time.time()
-        patient_ids_unique = list(set(patient_ids))  # Ensure uniqueness
-        patients_df = pd.DataFrame({"patient_id": patient_ids_unique})
+        patient_ids_unique = pd.unique(np.asarray(patient_ids, dtype=object))  # Ensure uniqueness
+        fhir_paths = [
+            ("linked_patient_id", "link.other.reference"),
+            ("meta_patient", "id"),
+            ("birth_date", "birthDate"),
+            ("sex", "gender"),
+            ("deceased_date", "deceasedDateTime"),
+        ]
 
+        meta_patient_path = self.output_dir / "meta_patients.parquet"
+        unlinked_path = self.output_dir / "unlinked_patients.parquet"
+        previous_df = pd.DataFrame()
+        previous_unlinked = pd.Series([], dtype=object)
+        if not (force_refresh or self.force_refresh):
+            try:
+                known_ids = []
+                if meta_patient_path.exists():
+                    previous_df = pd.read_parquet(meta_patient_path)
+                    known_ids += [previous_df["patient_id"], previous_df["linked_patient_id"]]
+                if unlinked_path.exists():
+                    previous_unlinked = pd.read_parquet(unlinked_path)["patient_id"]
+                    known_ids.append(previous_unlinked)
+                if known_ids:
+                    known_ids = pd.Index(pd.concat(known_ids).dropna().astype(str).unique())
+                    patient_ids_unique = patient_ids_unique[~pd.Index(patient_ids_unique.astype(str)).isin(known_ids)]
+                    logger.info(f"{len(patient_ids_unique)} patients are not covered by earlier runs yet")
+            except Exception as e:
+                logger.warning(f"Could not reuse earlier meta patients, querying all patients: {e}")
+                previous_df = pd.DataFrame()
+                previous_unlinked = pd.Series([], dtype=object)
+
+        answered_ids = []
         try:
-            result = self.search.trade_rows_for_dataframe(
-                df=patients_df,
-                df_constraints={"link": "patient_id"},
-                resource_type="Patient",
-                fhir_paths=[
-                    ("linked_patient_id", "link.other.reference"),
-                    ("meta_patient", "id"),
-                    ("birth_date", "birthDate"),
-                    ("sex", "gender"),
-                    ("deceased_date", "deceasedDateTime"),
-                ],
-                with_ref=True,
-            )
-            # Process the result into meta_patients_df (as before)
-            if isinstance(result, dict):
-                meta_patients_df = pd.DataFrame()
-                for key, value in result.items():
-                    if isinstance(value, pd.DataFrame) and not value.empty:
-                        meta_patients_df = value
-                        break
-            else:
-                meta_patients_df = result
+            # The batch searches are independent, run them concurrently over the pooled session
+            id_batches = [patient_ids_unique[i:i + batch_size] for i in range(0, len(patient_ids_unique), batch_size)]
+            with ThreadPoolExecutor(max_workers=max(1, min(self.num_processes, len(id_batches)))) as executor:
+                results = list(executor.map(lambda id_batch: self._search_linked_patients(id_batch, fhir_paths), id_batches))
+            answered_ids = [patient_id for _, batch_ids in results for patient_id in batch_ids]
+            batches = [batch for batch, _ in results if not batch.empty]
+            meta_patients_df = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
 
             if not meta_patients_df.empty and "linked_patient_id" in meta_patients_df.columns:
                 meta_patients_df = meta_patients_df.explode("linked_patient_id")
-                meta_patients_df["linked_patient_id"] = meta_patients_df["linked_patient_id"].apply(
-                    lambda x: extract_id(x) if pd.notna(x) else None
-                )
+                # Strip the "Patient/" prefix by slicing after the last "/", str.rsplit would build
+                # a list per reference
+                linked_ids = meta_patients_df["linked_patient_id"]
+                mask = linked_ids.notna()
+                meta_patients_df.loc[mask, "linked_patient_id"] = [
+                    reference[reference.rfind("/") + 1:] for reference in linked_ids[mask].astype(str)
+                ]
+                # Batched searches carry no query reference, so each linked ID is its own patient_id
+                if "patient_id" in meta_patients_df.columns:
+                    # Rows without a link reference fall back to the queried patient
+                    linked_ids = meta_patients_df["linked_patient_id"]
+                    meta_patients_df["linked_patient_id"] = linked_ids.where(
+                        linked_ids.notna(), meta_patients_df["patient_id"]
+                    )
+                    meta_patients_df["patient_id"] = meta_patients_df["patient_id"].fillna(
+                        meta_patients_df["linked_patient_id"]
+                    )
+                else:
+                    meta_patients_df["patient_id"] = meta_patients_df["linked_patient_id"]
             elif not meta_patients_df.empty:
                 meta_patients_df["linked_patient_id"] = meta_patients_df["patient_id"]
                 meta_patients_df["meta_patient"] = meta_patients_df["patient_id"]
@@ -284,11 +864,28 @@ class SimpleMetaPatientBuilder:
         except Exception as e:
             logger.error(f"Error building meta patients: {e}")
             meta_patients_df = pd.DataFrame()  # Return empty DataFrame on error
+            answered_ids = []
 
-        # Store meta patients
-        meta_patient_path = self.output_dir / "meta_patients.csv"
+        # Remember the answered patients without a meta patient, so later runs skip them as well
+        linked_ids = set()
+        if not meta_patients_df.empty:
+            linked_ids = set(meta_patients_df["patient_id"].dropna().astype(str))
+            linked_ids.update(meta_patients_df["linked_patient_id"].dropna().astype(str))
+        unlinked_ids = [patient_id for patient_id in map(str, answered_ids) if patient_id not in linked_ids]
+        if unlinked_ids:
+            unlinked_ids = pd.unique(np.asarray(list(previous_unlinked.astype(str)) + unlinked_ids, dtype=object))
+            store_df(pd.DataFrame({"patient_id": unlinked_ids}), unlinked_path, "unlinked_patients")
+
+        # Store meta patients, together with the ones found by earlier runs. This single
+        # deduplication also covers meta patients linking IDs from several batches, which
+        # are returned once per batch
         if not meta_patients_df.empty:
+            meta_patients_df = pd.concat([previous_df, meta_patients_df], ignore_index=True).drop_duplicates(
+                subset=["patient_id", "linked_patient_id"], ignore_index=True
+            )
             store_df(meta_patients_df, meta_patient_path, "meta_patients")
+        elif not previous_df.empty:
+            meta_patients_df = previous_df
         else:
             logger.warning("No meta-patient data to store.")
 
@@ -306,47 +903,81 @@ def main():
     builder = SimpleMetaPatientBuilder(num_processes=20, resources_per_page=750, is_initial_test=False)
     # builder = SimpleMetaPatientBuilder(num_processes=5, resources_per_page=100, is_initial_test=True) # For initial testing
 
-    # Extract resources
-    procedures_df, procedure_patient_ids = builder.extract_procedures()
-    observations_df, observation_patient_ids = builder.extract_observations()
-    diagnoses_df, diagnosis_patient_ids = builder.extract_diagnoses()
-    medications_df, _ = builder.extract_medications()
-    medication_statements_df, medication_statement_patient_ids = builder.extract_medication_statements()
+    # Fetch everything with one bulk export if enabled, otherwise fetch the first page of every
+    # resource in one batch request; the extractions below follow on from those pages or
+    # search on their own if the server has no batch support
+    resource_types = ["Procedure", "Observation", "Condition", "Medication", "MedicationStatement"]
+    export_types = [
+        resource_type for resource_type in resource_types
+        if not builder.is_search_cached(resource_type, {}, _FHIR_PATHS[resource_type])
+    ]
+    if not (builder.use_bulk_export and export_types and builder.bulk_export(export_types)):
+        builder.prefetch_first_pages([(resource_type, {}, _FHIR_PATHS[resource_type]) for resource_type in resource_types])
+
+    # Extract resources concurrently, the extractions are independent and I/O-bound
+    tasks = {
+        "procedures": builder.extract_procedures,
+        "observations": builder.extract_observations,
+        "diagnoses": builder.extract_diagnoses,
+        "medications": builder.extract_medications,
+        "medication_statements": builder.extract_medication_statements,
+    }
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {name: executor.submit(extract) for name, extract in tasks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+
+    procedures_df, procedure_patient_ids = results["procedures"]
+    observations_df, observation_patient_ids = results["observations"]
+    diagnoses_df, diagnosis_patient_ids = results["diagnoses"]
+    medications_df, _ = results["medications"]
+    medication_statements_df, medication_statement_patient_ids = results["medication_statements"]
 
     # Combine all patient IDs (ensure uniqueness)
-    all_patient_ids = list(set(
-        procedure_patient_ids + observation_patient_ids + diagnosis_patient_ids + medication_statement_patient_ids
-    ))
+    all_patient_ids = pd.unique(np.concatenate([
+        procedure_patient_ids, observation_patient_ids, diagnosis_patient_ids, medication_statement_patient_ids
+    ]))
     logger.info(f"Found {len(all_patient_ids)} unique patients across all patient-linked resources")
 
-    if all_patient_ids:
+    if len(all_patient_ids) > 0:
         # Build meta patients
         meta_patients_df = builder.build_meta_patients(all_patient_ids)
 
-        # Merge the extracted data with meta patients
-        if not procedures_df.empty and not meta_patients_df.empty:
-            merged_procedures_df = pd.merge(
-                procedures_df, meta_patients_df, how="inner", left_on="patient_id", right_on="linked_patient_id", suffixes=('_procedure', '_meta_patient')
-            )
-            store_df(merged_procedures_df, builder.output_dir / "procedures_with_meta_patients.csv", "procedures_with_meta_patients")
-
-        if not observations_df.empty and not meta_patients_df.empty:
-            merged_observations_df = pd.merge(
-                observations_df, meta_patients_df, how="inner", left_on="patient_id", right_on="linked_patient_id", suffixes=('_observation', '_meta_patient')
-            )
-            store_df(merged_observations_df, builder.output_dir / "observations_with_meta_patients.csv", "observations_with_meta_patients")
-
-        if not diagnoses_df.empty and not meta_patients_df.empty:
-            merged_diagnoses_df = pd.merge(
-                diagnoses_df, meta_patients_df, how="inner", left_on="patient_id", right_on="linked_patient_id", suffixes=('_diagnosis', '_meta_patient')
-            )
-            store_df(merged_diagnoses_df, builder.output_dir / "diagnoses_with_meta_patients.csv", "diagnoses_with_meta_patients")
-
-        if not medication_statements_df.empty and not meta_patients_df.empty:
-            merged_medication_statements_df = pd.merge(
-                medication_statements_df, meta_patients_df, how="inner", left_on="patient_id", right_on="linked_patient_id", suffixes=('_medication_statement', '_meta_patient')
+        if not meta_patients_df.empty:
+            merges = [
+                (name, resource_df, resource_suffix)
+                for name, resource_df, resource_suffix in [
+                    ("procedures", procedures_df, "_procedure"),
+                    ("observations", observations_df, "_observation"),
+                    ("diagnoses", diagnoses_df, "_diagnosis"),
+                    ("medication_statements", medication_statements_df, "_medication_statement"),
+                ]
+                if not resource_df.empty and "patient_id" in resource_df.columns
+            ]
+
+            # Encode all join keys against one shared dictionary so the joins compare integer codes
+            patient_categories = pd.concat(
+                [meta_patients_df["linked_patient_id"]] + [resource_df["patient_id"] for _, resource_df, _ in merges]
+            ).dropna().unique()
+            meta_patients_df["linked_patient_id"] = pd.Categorical(
+                meta_patients_df["linked_patient_id"], categories=patient_categories
             )
-            store_df(merged_medication_statements_df, builder.output_dir / "medication_statements_with_meta_patients.csv", "medication_statements_with_meta_patients")
+            # The extracted frames are not used after the merge, so encode them in place
+            # instead of copying every frame with assign
+            for _, resource_df, _ in merges:
+                resource_df["patient_id"] = pd.Categorical(resource_df["patient_id"], categories=patient_categories)
+
+            # Index meta patients once so every join below reuses the same lookup
+            meta_idx = meta_patients_df.set_index("linked_patient_id", drop=False).sort_index()
+
+            def merge_and_store(name, resource_df, resource_suffix):
+                merged_df = join_meta_patients(resource_df, meta_idx, resource_suffix)
+                merged_path = builder.output_dir / f"{name}_with_meta_patients.{builder.output_format}"
+                store_df(merged_df, merged_path, f"{name}_with_meta_patients")
+
+            # Merge the extracted data with meta patients, the joins share the read-only index
+            if merges:
+                with ThreadPoolExecutor(max_workers=len(merges)) as executor:
+                    list(executor.map(lambda merge: merge_and_store(*merge), merges))
 
     else:
         logger.warning("No patient IDs found, skipping meta-patient building and merging.")
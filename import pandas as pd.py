@@ -1,5 +1,5 @@
-import pandas as pd
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 
 csv_file_path1 = 'C:/Users/Praveen Nath/Desktop/merge/output3_file.csv'
 csv_file_path2 = 'C:/Users/Praveen Nath/Desktop/merge/procedure.csv'
@@ -7,26 +7,31 @@ join_column = 'fhir_patient_id'
 output_csv_path = 'C:/Users/Praveen Nath/Desktop/merge/output3_file.csv'
 
 try:
-    # Read the CSVs — try with default ',' separator first
-    df1 = pd.read_csv(csv_file_path1)
-    df2 = pd.read_csv(csv_file_path2, sep=';')  # keep this if you’re sure it’s semicolon-delimited
+    # Read the CSVs with pyarrow's multithreaded parser — default ',' separator first
+    table1 = pv.read_csv(csv_file_path1)
+    table2 = pv.read_csv(
+        csv_file_path2,
+        parse_options=pv.ParseOptions(delimiter=';'),  # keep this if you’re sure it’s semicolon-delimited
+    )
 
     # Strip whitespace from column names
-    df1.columns = df1.columns.str.strip()
-    df2.columns = df2.columns.str.strip()
+    table1 = table1.rename_columns([name.strip() for name in table1.column_names])
+    table2 = table2.rename_columns([name.strip() for name in table2.column_names])
 
-    print("df1 columns:", repr(df1.columns.tolist()))
-    print("df2 columns:", repr(df2.columns.tolist()))
+    print("table1 columns:", repr(table1.column_names))
+    print("table2 columns:", repr(table2.column_names))
 
-    # Merge on 'patient_id'
-    merged_df = pd.merge(df1, df2, on=join_column, how='inner')
+    # Hash join on 'fhir_patient_id' directly in Arrow, no pandas round-trip
+    merged_table = table1.join(
+        table2, keys=join_column, join_type='inner', left_suffix='_x', right_suffix='_y'
+    )
 
-    merged_df.to_csv(output_csv_path, index=False)
+    pv.write_csv(merged_table, output_csv_path)
     print(f"\nMerged file saved to: {output_csv_path}")
 
 except FileNotFoundError:
     print("File not found. Check paths.")
-except KeyError as e:
-    print(f"KeyError: {e}. Column might be missing or misnamed.")
+except (KeyError, pa.ArrowInvalid) as e:
+    print(f"Column error: {e}. Column might be missing or misnamed.")
 except Exception as e:
     print(f"Other error: {e}")
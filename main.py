@@ -1,55 +1,95 @@
 import pandas as pd
-from pm4py.objects.conversion.log import converter as log_converter
+import pyarrow.csv as pv
+from pathlib import Path
+from pm4py import discover_petri_net_inductive
 from pm4py.objects.log.util import dataframe_utils
-from pm4py.algo.discovery.inductive import algorithm as inductive_miner
 from pm4py.visualization.petri_net import visualizer as pn_visualizer
-from pm4py.objects.conversion.process_tree import converter as pt_converter
-
-# 1. Load and prepare data
-df = pd.read_csv(r"C:\Users\Praveen Nath\Desktop\RP14cohort.csv", sep=";")
-df.columns = df.columns.str.strip()
-
-# 2. Map columns to PM4Py standard
-column_mapping = {
-    'encounter_id': 'case:concept:name',
-    'type_display': 'concept:name',
-    'start_time': 'time:timestamp'
-}
-df = df.rename(columns=column_mapping)
-df['time:timestamp'] = pd.to_datetime(df['time:timestamp'], errors='coerce', utc=True)
-df = df.dropna(subset=['time:timestamp'])
-
-# 3. Convert to event log (preserving all attributes)
-event_log = log_converter.apply(df)
-
-# 4. Discover process model
-process_tree = inductive_miner.apply(event_log)
-net, initial_marking, final_marking = pt_converter.apply(process_tree)
-
-# 5. Create ENHANCED visualization with attributes
-parameters = {
-    pn_visualizer.Variants.WO_DECORATION.value.Parameters.FORMAT: "png",
-    # Show all attributes in labels
-    "show_attributes": True,
-    # Specific attributes to highlight
-    "highlighted_attributes": ["observation_display", "procedure_display", "icd_10_display"],
-    # Visual styling
-    "bgcolor": "white",
-    "font_size": "14"
-}
-
-# Create visualization with attributes
-gviz = pn_visualizer.apply(
-    net, 
-    initial_marking, 
-    final_marking,
-    parameters=parameters,
-    # Add log to enable attribute visualization
-    log=event_log,
-    # Show all variants
-    variant=pn_visualizer.Variants.WO_DECORATION
-)
-
-# Save and show
-pn_visualizer.save(gviz, "enhanced_process_model.png")
-pn_visualizer.view(gviz)
\ No newline at end of file
+
+CSV_PATH = Path(r"C:\Users\Praveen Nath\Desktop\RP14cohort.csv")
+# Bump whenever load_event_log prepares the events differently, cached Parquet files of older
+# versions are then rebuilt from the CSV
+EVENT_LOG_VERSION = 2
+
+
+def load_event_log(csv_path):
+    """Load the cohort CSV as a PM4Py-ready DataFrame."""
+    # The prepared event log is kept next to the CSV as Parquet, so re-runs skip CSV and timestamp parsing
+    parquet_path = csv_path.with_suffix(f".v{EVENT_LOG_VERSION}.parquet")
+    if parquet_path.exists() and parquet_path.stat().st_mtime >= csv_path.stat().st_mtime:
+        df = pd.read_parquet(parquet_path)
+    else:
+        # Only the event columns and the highlighted attributes are used below; the header is read
+        # first because its names may carry whitespace
+        event_columns = {'encounter_id', 'type_display', 'start_time', 'observation_display', 'procedure_display', 'icd_10_display'}
+        header = pd.read_csv(csv_path, sep=";", nrows=0).columns
+        # Read with pyarrow's CSV reader; strings_can_be_null keeps empty and "NA"-like text
+        # cells missing like the C engine does, pandas' pyarrow engine reads them as strings
+        df = pv.read_csv(
+            csv_path,
+            parse_options=pv.ParseOptions(delimiter=";"),
+            convert_options=pv.ConvertOptions(
+                include_columns=[c for c in header if c.strip() in event_columns],
+                strings_can_be_null=True,
+            ),
+        ).to_pandas()
+        df.columns = df.columns.str.strip()
+
+        # 2. Map columns to PM4Py standard
+        column_mapping = {
+            'encounter_id': 'case:concept:name',
+            'type_display': 'concept:name',
+            'start_time': 'time:timestamp'
+        }
+        df = df.rename(columns=column_mapping)
+        # Repeated timestamps are parsed only once
+        df['time:timestamp'] = pd.to_datetime(df['time:timestamp'], errors='coerce', utc=True, cache=True)
+        df = df.dropna(subset=['time:timestamp'])
+        # The display attributes repeat a few hundred values over all events, store them as categories
+        for column in ['observation_display', 'procedure_display', 'icd_10_display']:
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        # Sort events by case and time once, also for the cached Parquet, so PM4Py finds them in order
+        df = df.sort_values(['case:concept:name', 'time:timestamp'], kind='stable', ignore_index=True)
+        df.to_parquet(parquet_path, engine="pyarrow", compression="zstd", index=False)
+    return df
+
+
+def main():
+    # 1. Load and prepare data
+    df = load_event_log(CSV_PATH)
+
+    # 3. Discover process model as a Petri net straight from the DataFrame, without building
+    # an EventLog object first
+    net, initial_marking, final_marking = discover_petri_net_inductive(
+        df, activity_key='concept:name', case_id_key='case:concept:name', timestamp_key='time:timestamp'
+    )
+
+    # 4. Create ENHANCED visualization with attributes
+    parameters = {
+        pn_visualizer.Variants.WO_DECORATION.value.Parameters.FORMAT: "png",
+        # Show all attributes in labels
+        "show_attributes": True,
+        # Specific attributes to highlight
+        "highlighted_attributes": ["observation_display", "procedure_display", "icd_10_display"],
+        # Visual styling
+        "bgcolor": "white",
+        "font_size": "14"
+    }
+
+    # Create visualization with attributes
+    gviz = pn_visualizer.apply(
+        net, 
+        initial_marking, 
+        final_marking,
+        parameters=parameters,
+        # Show all variants
+        variant=pn_visualizer.Variants.WO_DECORATION
+    )
+
+    # Save and show
+    pn_visualizer.save(gviz, "enhanced_process_model.png")
+    pn_visualizer.view(gviz)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,71 @@
+import json
+import os
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+os.environ.setdefault("FHIR_USER", "test")
+
+import build_meta.meta_patient_builder as meta_patient_builder  # noqa: E402
+
+BASE_URL = "http://fhir.test/fhir"
+
+
+class FakeFHIRAdapter(BaseAdapter):
+    """Answer requests with handler(request) -> (status_code, body) instead of the network."""
+
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status_code, body = self.handler(request)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode()
+        # The whole body is already read, also for stream=True requests
+        response._content_consumed = True
+        response.headers["Content-Type"] = "application/fhir+json"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def query(request):
+    """Return the resource path and the query parameters of a request."""
+    url = urlsplit(request.url)
+    return url.path.removeprefix("/fhir/"), {key: values[0] for key, values in parse_qs(url.query).items()}
+
+
+def searchset(resources, total=None, next_url=None):
+    """Build a searchset Bundle of the given resources."""
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": len(resources) if total is None else total,
+        "link": [{"relation": "next", "url": next_url}] if next_url else [],
+        "entry": [{"resource": resource} for resource in resources],
+    }
+
+
+@pytest.fixture
+def make_builder(tmp_path, monkeypatch):
+    # Ahoy logs in on construction, Pirate takes the builder's session directly instead
+    monkeypatch.setattr(meta_patient_builder, "Ahoy", lambda session, **kwargs: session)
+
+    def make(handler, **kwargs):
+        kwargs.setdefault("num_processes", 2)
+        builder = meta_patient_builder.SimpleMetaPatientBuilder(base_url=BASE_URL, output_dir=tmp_path, **kwargs)
+        builder.adapter = FakeFHIRAdapter(handler)
+        builder.session.mount("http://", builder.adapter)
+        return builder
+
+    return make
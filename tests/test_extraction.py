@@ -0,0 +1,143 @@
+import json
+from types import SimpleNamespace
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import build_meta.meta_patient_builder as meta_patient_builder
+from conftest import BASE_URL, query, searchset
+
+
+def observation(index):
+    return {
+        "resourceType": "Observation",
+        "id": f"o{index}",
+        "status": "final",
+        "subject": {"reference": f"Patient/p{index % 3}"},
+        "code": {"coding": [{"code": "c1", "display": "Code one"}]},
+        "valueQuantity": {"value": index + 0.5},
+    }
+
+
+def paged_observations(n_pages, per_page, outcome_first=False):
+    """Serve n_pages pages of Observations, linked by next URLs."""
+
+    def handler(request):
+        resource_type, params = query(request)
+        assert resource_type == "Observation"
+        page = int(params.get("page", 1))
+        resources = [observation((page - 1) * per_page + i) for i in range(per_page)]
+        if outcome_first:
+            resources.insert(0, {"resourceType": "OperationOutcome", "id": "warning"})
+        next_url = f"{BASE_URL}/Observation?page={page + 1}" if page < n_pages else None
+        return 200, searchset(resources, total=n_pages * per_page, next_url=next_url)
+
+    return handler
+
+
+def test_streaming_flushes_columns_that_stay_empty(make_builder, monkeypatch):
+    monkeypatch.setattr(meta_patient_builder, "_ROW_GROUP_ROWS", 4)
+    builder = make_builder(paged_observations(n_pages=4, per_page=2), resources_per_page=2)
+
+    observations_df, patient_ids = builder.extract_observations()
+
+    parquet_file = pq.ParquetFile(builder.output_dir / "observations.parquet")
+    assert parquet_file.metadata.num_row_groups == 2
+    assert parquet_file.schema_arrow.field("value_unit").type == "string"
+    assert len(observations_df) == 8
+    assert observations_df["value_unit"].isna().all()
+    assert sorted(patient_ids) == ["p0", "p1", "p2"]
+    assert observations_df["value_quantity"].tolist() == [i + 0.5 for i in range(8)]
+
+
+def test_streaming_writes_the_requested_resource_type(make_builder):
+    builder = make_builder(paged_observations(n_pages=3, per_page=2, outcome_first=True), resources_per_page=2)
+
+    observations_df, _ = builder.extract_observations()
+
+    assert observations_df["observation_id"].tolist() == [f"o{i}" for i in range(6)]
+
+
+def test_small_search_fetches_the_first_page_once(make_builder):
+    builder = make_builder(paged_observations(n_pages=1, per_page=3))
+
+    observations_df, patient_ids = builder.extract_observations()
+
+    assert len(builder.adapter.requests) == 1
+    assert observations_df["observation_id"].tolist() == ["o0", "o1", "o2"]
+    assert sorted(patient_ids) == ["p0", "p1", "p2"]
+
+
+def batch_or_paged_observations(n_pages, per_page):
+    """Answer batch searches with the first page of paged_observations, and the next links as usual."""
+    paged = paged_observations(n_pages, per_page)
+
+    def handler(request):
+        if request.method != "POST":
+            return paged(request)
+        entries = json.loads(request.body)["entry"]
+        _, first_page = paged(SimpleNamespace(url=f"{BASE_URL}/Observation"))
+        return 200, {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": {"status": "200 OK"}, "resource": first_page} for _ in entries],
+        }
+
+    return handler
+
+
+def test_prefetched_search_is_not_searched_again(make_builder):
+    builder = make_builder(batch_or_paged_observations(n_pages=2, per_page=2), resources_per_page=2)
+
+    builder.prefetch_first_pages([("Observation", {}, meta_patient_builder._FHIR_PATHS["Observation"])])
+    observations_df, _ = builder.extract_observations()
+
+    (batch, next_page) = builder.adapter.requests
+    assert json.loads(batch.body)["entry"][0]["request"]["url"] == "Observation?_count=2&_sort=_id"
+    assert query(next_page)[1] == {"page": "2"}
+    assert len(observations_df) == 4
+
+
+def test_cached_search_is_not_prefetched(make_builder):
+    handler = batch_or_paged_observations(n_pages=1, per_page=2)
+    make_builder(handler).extract_observations()
+
+    builder = make_builder(handler)
+    builder.prefetch_first_pages([("Observation", {}, meta_patient_builder._FHIR_PATHS["Observation"])])
+    observations_df, _ = builder.extract_observations()
+
+    assert builder.adapter.requests == []
+    assert len(observations_df) == 2
+
+
+def test_exported_resources_are_cached(make_builder):
+    def handler(request):
+        # A single resource is a one-line NDJSON export file
+        assert request.url == f"{BASE_URL}/export/Observation.ndjson"
+        return 200, observation(0)
+
+    builder = make_builder(handler)
+    builder._export_files = {"Observation": [f"{BASE_URL}/export/Observation.ndjson"]}
+    exported_df, _ = builder.extract_observations()
+
+    builder = make_builder(lambda request: (500, {}))
+    cached_df, _ = builder.extract_observations()
+
+    assert builder.adapter.requests == []
+    assert cached_df["observation_id"].tolist() == exported_df["observation_id"].tolist() == ["o0"]
+
+
+def test_bulk_export_defaults_to_environment_variable(make_builder, monkeypatch):
+    monkeypatch.setenv("USE_BULK_EXPORT", "true")
+
+    assert make_builder(lambda request: (500, {})).use_bulk_export
+    assert not make_builder(lambda request: (500, {}), use_bulk_export=False).use_bulk_export
+
+
+def test_store_df_writes_csv_in_slices(tmp_path, monkeypatch):
+    monkeypatch.setattr(meta_patient_builder, "_CSV_CHUNK_ROWS", 2)
+    df = pd.DataFrame({"observation_id": [f"o{i}" for i in range(5)], "value_quantity": [0.5, None, 2.5, 3.5, 4.5]})
+
+    meta_patient_builder.store_df(df, tmp_path / "observations.csv", "observations")
+
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "observations.csv"), df)
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import numpy as np
+
+from conftest import query, searchset
+
+
+def linking_patient(meta_id, patient_id):
+    return {"resourceType": "Patient", "id": meta_id, "link": [{"other": {"reference": f"Patient/{patient_id}"}}]}
+
+
+def test_per_patient_fallback_keeps_other_batches(make_builder):
+    linked = {"A": "MA", "B": "MB"}
+
+    def handler(request):
+        _, params = query(request)
+        if "," in params["link"]:
+            return 400, {"resourceType": "OperationOutcome"}
+        meta_id = linked.get(params["link"])
+        return 200, searchset([linking_patient(meta_id, params["link"])] if meta_id else [])
+
+    builder = make_builder(handler)
+    meta_patients_df = builder.build_meta_patients(np.array(["A", "B", "X", "Y"], dtype=object), batch_size=2)
+
+    assert sorted(zip(meta_patients_df["linked_patient_id"], meta_patients_df["meta_patient"])) == [
+        ("A", "MA"),
+        ("B", "MB"),
+    ]
+
+
+def test_empty_batch_is_not_searched_per_patient(make_builder):
+    def handler(request):
+        _, params = query(request)
+        if params["link"] == "A,B":
+            return 200, searchset([linking_patient("MA", "A")])
+        return 200, searchset([])
+
+    builder = make_builder(handler)
+    meta_patients_df = builder.build_meta_patients(np.array(["A", "B", "X", "Y"], dtype=object), batch_size=2)
+
+    assert list(meta_patients_df["meta_patient"]) == ["MA"]
+    assert sorted(query(request)[1]["link"] for request in builder.adapter.requests) == ["A,B", "X,Y"]
+
+
+def test_operation_outcome_error_falls_back_per_patient(make_builder):
+    def handler(request):
+        _, params = query(request)
+        if "," in params["link"]:
+            outcome = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-supported"}]}
+            return 200, searchset([outcome])
+        return 200, searchset([linking_patient("M" + params["link"], params["link"])])
+
+    builder = make_builder(handler)
+    meta_patients_df = builder.build_meta_patients(np.array(["A", "B"], dtype=object))
+
+    assert sorted(meta_patients_df["meta_patient"]) == ["MA", "MB"]
+
+
+def test_per_patient_fallback_stays_within_num_processes(make_builder):
+    lock = threading.Lock()
+    in_flight, max_in_flight = 0, 0
+
+    def handler(request):
+        nonlocal in_flight, max_in_flight
+        _, params = query(request)
+        if "," in params["link"]:
+            return 400, {"resourceType": "OperationOutcome"}
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        return 200, searchset([linking_patient("M" + params["link"], params["link"])])
+
+    builder = make_builder(handler, num_processes=2)
+    ids = np.array(["A", "B", "C", "D", "E", "F", "G", "H"], dtype=object)
+    meta_patients_df = builder.build_meta_patients(ids, batch_size=4)
+
+    assert max_in_flight <= 2
+    assert len(meta_patients_df) == 8
+
+
+def test_patients_without_meta_patient_are_not_queried_again(make_builder):
+    def handler(request):
+        _, params = query(request)
+        linked = [linking_patient("MA", "A")] if "A" in params["link"].split(",") else []
+        return 200, searchset(linked)
+
+    make_builder(handler).build_meta_patients(np.array(["A", "B", "X"], dtype=object))
+
+    builder = make_builder(handler)
+    meta_patients_df = builder.build_meta_patients(np.array(["A", "B", "X", "Z"], dtype=object))
+    assert [query(request)[1]["link"] for request in builder.adapter.requests] == ["Z"]
+    assert list(meta_patients_df["meta_patient"]) == ["MA"]
+
+    builder = make_builder(handler, force_refresh=True)
+    builder.build_meta_patients(np.array(["A", "B", "X", "Z"], dtype=object))
+    assert [query(request)[1]["link"] for request in builder.adapter.requests] == ["A,B,X,Z"]
+
+
+def test_failed_patient_searches_are_queried_again(make_builder):
+    def handler(request):
+        _, params = query(request)
+        if "," in params["link"] or params["link"] == "X":
+            return 400, {"resourceType": "OperationOutcome"}
+        return 200, searchset([])
+
+    make_builder(handler).build_meta_patients(np.array(["B", "X"], dtype=object))
+
+    builder = make_builder(handler)
+    builder.build_meta_patients(np.array(["B", "X"], dtype=object))
+    assert {query(request)[1]["link"] for request in builder.adapter.requests} == {"X"}
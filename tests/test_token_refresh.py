@@ -0,0 +1,87 @@
+import threading
+
+import requests
+from fhir_pyrate.util.token_auth import TokenAuth
+
+from build_meta.meta_patient_builder import coalesce_token_refresh
+from conftest import FakeFHIRAdapter
+
+
+def token_session(fhir_handler):
+    """Return a session authenticated by a TokenAuth whose refresh hands out new tokens."""
+    session = requests.Session()
+    token_auth = TokenAuth(token="token-0", session=session, refresh_url="http://auth.test/refresh")
+    session.auth = token_auth
+    refreshes = []
+
+    def refresh_handler(request):
+        refreshes.append(request)
+        return 200, f"token-{len(refreshes)}"
+
+    token_auth._token_session.mount("http://", FakeFHIRAdapter(refresh_handler))
+    session.mount("http://", FakeFHIRAdapter(fhir_handler))
+    coalesce_token_refresh(session)
+    return session, refreshes
+
+
+def get_with_timeout(session, url, timeout=5):
+    """Run session.get in a thread so that a deadlock fails the test instead of hanging it."""
+    outcome = {}
+
+    def get():
+        try:
+            outcome["response"] = session.get(url)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=get, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "request deadlocked in the refresh hook"
+    return outcome
+
+
+def test_refreshes_once_and_resends():
+    def handler(request):
+        if request.headers["Authorization"] == 'Bearer "token-1"':
+            return 200, {"resourceType": "Bundle"}
+        return 401, {}
+
+    session, refreshes = token_session(handler)
+    outcome = get_with_timeout(session, "http://fhir.test/fhir/Patient")
+
+    assert outcome["response"].status_code == 200
+    assert len(refreshes) == 1
+
+
+def test_repeated_unauthorized_raises_instead_of_hanging():
+    session, refreshes = token_session(lambda request: (401, {}))
+    outcome = get_with_timeout(session, "http://fhir.test/fhir/Patient")
+
+    assert isinstance(outcome.get("error"), requests.HTTPError)
+    assert len(refreshes) == session.auth._max_login_attempts - 1
+
+
+def test_concurrent_unauthorized_refresh_once():
+    workers = 4
+    barrier = threading.Barrier(workers)
+
+    def handler(request):
+        if request.headers["Authorization"] == 'Bearer token-0':
+            barrier.wait(timeout=5)
+            return 401, {}
+        return 200, {"resourceType": "Bundle"}
+
+    session, refreshes = token_session(handler)
+    outcomes = []
+    threads = [
+        threading.Thread(target=lambda: outcomes.append(get_with_timeout(session, "http://fhir.test/fhir/Patient")))
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert [outcome["response"].status_code for outcome in outcomes] == [200] * workers
+    assert len(refreshes) == 1